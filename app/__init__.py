@@ -5,7 +5,7 @@ import config
 
 from .blueprints.todo import todo_bp
 from .blueprints.user import user_bp
-from .extensions import api, bcrypt, db, jwt
+from .extensions import admission, api, bcrypt, db, jwt
 
 
 def create_app(app_config=None):
@@ -31,6 +31,7 @@ def create_app(app_config=None):
     api.init_app(app)
     bcrypt.init_app(app)
     jwt.init_app(app)
+    admission.init_app(app)
 
     # Create database tables within the application context
     with app.app_context():
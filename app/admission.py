@@ -0,0 +1,428 @@
+"""Contains admission control and load shedding for the application."""
+import contextlib
+import math
+import random
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app, g, jsonify, request
+from flask_jwt_extended import get_jwt_identity, verify_jwt_in_request
+from flask_jwt_extended.exceptions import JWTExtendedException
+from jwt.exceptions import PyJWTError
+
+# Default settings, overridden by the 'ADMISSION_*' keys of the application
+# configuration.
+DEFAULT_SETTINGS = {
+    "ADMISSION_ENABLED": True,
+    "ADMISSION_MAX_CONCURRENCY": 16,
+    "ADMISSION_MAX_QUEUE": 32,
+    "ADMISSION_MAX_QUEUE_WAIT": 0.5,
+    "ADMISSION_TARGET_QUEUE_WAIT": 0.1,
+    "ADMISSION_MAX_SHED_RATIO": 0.9,
+    "ADMISSION_SHED_DECAY": 1.0,
+    "ADMISSION_USER_RATE": 20.0,
+    "ADMISSION_USER_BURST": 40,
+    "ADMISSION_MAX_CLIENTS": 10000,
+    "ADMISSION_RETRY_AFTER": 1,
+    "ADMISSION_BUDGETS": {
+        "login": {"rate": 1.0, "burst": 5, "concurrency": 2, "max_queue": 4},
+        "search": {"rate": 2.0, "burst": 5, "concurrency": 4, "max_queue": 8},
+    },
+}
+
+
+class TokenBucket:
+    """
+    Classic token bucket refilled continuously at a fixed rate.
+
+    :param rate: Number of tokens added per second.
+    :param burst: Maximum number of tokens the bucket can hold.
+    """
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+
+    def retry_after(self, now: float) -> float:
+        """Refill the bucket and tell whether a token is available.
+
+        :param now: The current monotonic time.
+        :return: 0.0 if a token is available, otherwise the number of
+                 seconds until the next token becomes available.
+        """
+        elapsed = max(0.0, now - self.updated_at)
+        self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+        self.updated_at = max(now, self.updated_at)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self, now: float) -> float:
+        """Take one token from the bucket.
+
+        :param now: The current monotonic time.
+        :return: 0.0 if a token was taken, otherwise the number of seconds
+                 until the next token becomes available.
+        """
+        retry_after = self.retry_after(now)
+        if not retry_after:
+            self.tokens -= 1
+        return retry_after
+
+
+class TokenBucketRegistry:
+    """
+    Collection of token buckets, one per client key.
+
+    The registry holds at most 'max_entries' buckets. Beyond that, the
+    bucket of the least recently seen client is evicted, so memory and
+    lookup time stay bounded however many clients show up. Callers must
+    hold 'lock' while using the registry and its buckets.
+
+    :param rate: Number of tokens added per second to each bucket.
+    :param burst: Maximum number of tokens each bucket can hold.
+    :param max_entries: Maximum number of buckets kept.
+    """
+
+    def __init__(self, rate: float, burst: float, max_entries: int):
+        self.rate = rate
+        self.burst = burst
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self._buckets = OrderedDict()
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def get(self, key) -> TokenBucket:
+        """Return the bucket belonging to 'key', creating it if needed.
+
+        :param key: The client identifier.
+        """
+        bucket = self._buckets.get(key)
+        if bucket is not None:
+            self._buckets.move_to_end(key)
+            return bucket
+        if len(self._buckets) >= self.max_entries:
+            self._buckets.popitem(last=False)
+        bucket = self._buckets[key] = TokenBucket(self.rate, self.burst)
+        return bucket
+
+
+def charge(registries, key) -> float:
+    """Take a token for 'key' from every registry, or from none of them.
+
+    :param registries: The token bucket registries to charge.
+    :param key: The client identifier.
+    :return: 0.0 if every bucket admitted the request, otherwise the
+             longest number of seconds to wait.
+    """
+    now = time.monotonic()
+    with contextlib.ExitStack() as stack:
+        for registry in registries:
+            stack.enter_context(registry.lock)
+        buckets = [registry.get(key) for registry in registries]
+        retry_after = max(bucket.retry_after(now) for bucket in buckets)
+        if retry_after:
+            return retry_after
+        for bucket in buckets:
+            bucket.consume(now)
+        return 0.0
+
+
+class ConcurrencyLimiter:
+    """
+    Limits the number of requests in progress, with a bounded wait queue.
+
+    :param limit: Maximum number of requests served at the same time.
+    :param max_queue: Maximum number of requests waiting for a free slot.
+    """
+
+    def __init__(self, limit: int, max_queue: int):
+        self.limit = limit
+        self.max_queue = max_queue
+        self.active = 0
+        self.waiting = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, timeout: float):
+        """Wait for a free slot.
+
+        :param timeout: Maximum number of seconds to wait in the queue.
+        :return: The seconds spent waiting, or None if no slot was acquired.
+        """
+        with self._cond:
+            if self.active < self.limit and self.waiting == 0:
+                self.active += 1
+                return 0.0
+            if self.waiting >= self.max_queue:
+                return None
+            start = time.monotonic()
+            deadline = start + timeout
+            self.waiting += 1
+            try:
+                while self.active >= self.limit:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return None
+                    self._cond.wait(remaining)
+                self.active += 1
+                return time.monotonic() - start
+            finally:
+                self.waiting -= 1
+
+    def release(self):
+        """Free a slot and wake up the next waiting request."""
+        with self._cond:
+            self.active -= 1
+            self._cond.notify()
+
+
+class QueueWaitShedder:
+    """
+    Sheds load adaptively based on the measured queue wait time.
+
+    An exponentially weighted moving average of the queue wait is kept. As
+    soon as it exceeds the target, new requests are rejected with a
+    probability proportional to the excess. The average also decays with
+    the time elapsed since the last sample, so shedding stops on its own
+    once the overload is over instead of waiting for the few admitted
+    requests to pull the average down.
+
+    :param target: Queue wait time (seconds) considered healthy.
+    :param max_ratio: Upper bound for the fraction of requests shed.
+    :param decay: Time constant (seconds) of the decay of the average.
+    :param alpha: Smoothing factor of the moving average.
+    """
+
+    def __init__(
+        self, target: float, max_ratio: float, decay: float, alpha: float = 0.2
+    ):
+        self.target = target
+        self.max_ratio = max_ratio
+        self.decay = decay
+        self.alpha = alpha
+        self.average_wait = 0.0
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def record(self, wait: float, now: float):
+        """Feed a measured queue wait time into the moving average.
+
+        :param wait: The measured queue wait time in seconds.
+        :param now: The current monotonic time.
+        """
+        with self._lock:
+            average = self.current_wait(now)
+            self.average_wait = average + self.alpha * (wait - average)
+            self.updated_at = now
+
+    def current_wait(self, now: float) -> float:
+        """The moving average of the queue wait, decayed up to 'now'."""
+        elapsed = max(0.0, now - self.updated_at)
+        return self.average_wait * math.exp(-elapsed / self.decay)
+
+    def should_shed(self, now: float) -> bool:
+        """Whether the current request should be rejected upfront.
+
+        :param now: The current monotonic time.
+        """
+        excess = (self.current_wait(now) - self.target) / self.target
+        if excess <= 0:
+            return False
+        return random.random() < min(excess, self.max_ratio)
+
+
+class Budget:
+    """
+    Separate rate and concurrency budget for an expensive endpoint.
+
+    Each budget sheds on its own queue wait, so that a saturated expensive
+    endpoint does not cause shedding across the rest of the API.
+
+    :param shedder: The queue wait shedder of this budget.
+    :param rate: Requests per second allowed for each client.
+    :param burst: Burst size allowed for each client.
+    :param concurrency: Maximum number of these requests served at once.
+    :param max_queue: Maximum number of these requests waiting for a slot.
+    :param max_clients: Maximum number of client buckets kept.
+    """
+
+    def __init__(
+        self, shedder, rate, burst, concurrency, max_queue, max_clients
+    ):
+        self.shedder = shedder
+        self.buckets = TokenBucketRegistry(rate, burst, max_clients)
+        self.limiter = ConcurrencyLimiter(concurrency, max_queue)
+
+
+class AdmissionState:
+    """Holds the admission control state of a single application."""
+
+    def __init__(self, config):
+        self.max_queue_wait = config["ADMISSION_MAX_QUEUE_WAIT"]
+        self.retry_after = config["ADMISSION_RETRY_AFTER"]
+        self.user_buckets = TokenBucketRegistry(
+            config["ADMISSION_USER_RATE"],
+            config["ADMISSION_USER_BURST"],
+            config["ADMISSION_MAX_CLIENTS"],
+        )
+        self.limiter = ConcurrencyLimiter(
+            config["ADMISSION_MAX_CONCURRENCY"], config["ADMISSION_MAX_QUEUE"]
+        )
+        self.shedder = self._create_shedder(config)
+        self.budgets = {
+            name: Budget(
+                self._create_shedder(config),
+                max_clients=config["ADMISSION_MAX_CLIENTS"],
+                **settings,
+            )
+            for name, settings in config["ADMISSION_BUDGETS"].items()
+        }
+
+    @staticmethod
+    def _create_shedder(config):
+        return QueueWaitShedder(
+            config["ADMISSION_TARGET_QUEUE_WAIT"],
+            config["ADMISSION_MAX_SHED_RATIO"],
+            config["ADMISSION_SHED_DECAY"],
+        )
+
+
+class AdmissionController:
+    """
+    Flask extension enforcing admission control on every request.
+
+    A request is charged one token from the per-user bucket and, when its
+    resource declares an expensive endpoint budget, one token from the
+    bucket of that budget. Tokens are only taken when both buckets admit
+    the request. It is then checked against the adaptive queue wait
+    shedders and finally the concurrency limits. Clients over their rate
+    receive a 429, requests rejected because the server is overloaded
+    receive a 503. Both carry a 'Retry-After' header. Requests that do not
+    match any route are not subject to admission control.
+
+    Resources opt into a budget through an 'admission_budget' attribute,
+    either the name of the budget or a callable taking the request and
+    returning that name (or None).
+
+    The settings are read from the application configuration:
+
+    - ADMISSION_ENABLED: Whether to enforce admission control.
+    - ADMISSION_MAX_CONCURRENCY: Requests served at the same time.
+    - ADMISSION_MAX_QUEUE: Requests allowed to wait for a free slot.
+    - ADMISSION_MAX_QUEUE_WAIT: Seconds a request may wait in the queues
+      (budget and global together) before it is rejected.
+    - ADMISSION_TARGET_QUEUE_WAIT: Average queue wait in seconds above
+      which load is shed.
+    - ADMISSION_MAX_SHED_RATIO: Upper bound for the fraction of requests
+      shed.
+    - ADMISSION_SHED_DECAY: Seconds for the average queue wait to decay
+      by a factor e when idle.
+    - ADMISSION_USER_RATE: Requests per second allowed per user.
+    - ADMISSION_USER_BURST: Burst size allowed per user.
+    - ADMISSION_MAX_CLIENTS: Client buckets kept per rate limit.
+    - ADMISSION_RETRY_AFTER: Seconds sent in the 'Retry-After' header of
+      503 responses.
+    - ADMISSION_BUDGETS: Rate ('rate', 'burst') and concurrency
+      ('concurrency', 'max_queue') budgets of expensive endpoints.
+
+    The defaults are listed in 'DEFAULT_SETTINGS'.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Install the admission hooks on the given application.
+
+        :param app: The Flask application instance.
+        """
+        for key, value in DEFAULT_SETTINGS.items():
+            app.config.setdefault(key, value)
+
+        if not app.config["ADMISSION_ENABLED"]:
+            return
+
+        app.extensions["admission"] = AdmissionState(app.config)
+        app.before_request(self._admit)
+        app.teardown_request(self._release)
+
+    def _admit(self):
+        g.admission_slots = []
+        # Unknown routes and redirects are answered without doing any work
+        if request.routing_exception is not None:
+            return
+
+        state = current_app.extensions["admission"]
+        key = _client_key()
+
+        budget = _find_budget(state)
+        registries = [state.user_buckets]
+        if budget is not None:
+            registries.insert(0, budget.buckets)
+        retry_after = charge(registries, key)
+        if retry_after:
+            return _reject(429, "Too many requests", retry_after)
+
+        # Acquire the budget slot first so that expensive requests do not
+        # hold a global slot while waiting for their own budget. Each queue
+        # feeds its own shedder.
+        queues = [(state.limiter, state.shedder)]
+        if budget is not None:
+            queues.insert(0, (budget.limiter, budget.shedder))
+
+        now = time.monotonic()
+        for _, shedder in queues:
+            if shedder.should_shed(now):
+                return _reject(503, "Server overloaded", state.retry_after)
+
+        # Both queues share one deadline, so that the total queueing time
+        # stays within 'ADMISSION_MAX_QUEUE_WAIT'.
+        deadline = now + state.max_queue_wait
+        for limiter, shedder in queues:
+            timeout = max(0.0, deadline - time.monotonic())
+            wait = limiter.acquire(timeout)
+            if wait is None:
+                # A rejection counts as the longest wait allowed, whatever
+                # part of the deadline was left for this queue.
+                shedder.record(state.max_queue_wait, time.monotonic())
+                return _reject(503, "Server overloaded", state.retry_after)
+            shedder.record(wait, time.monotonic())
+            g.admission_slots.append(limiter)
+
+    def _release(self, exc=None):
+        for limiter in g.pop("admission_slots", []):
+            limiter.release()
+
+
+def _client_key():
+    """Identify the client by its JWT identity, or its address otherwise."""
+    try:
+        verify_jwt_in_request(optional=True)
+        identity = get_jwt_identity()
+    except (JWTExtendedException, PyJWTError):
+        identity = None
+    if identity is not None:
+        return f"user:{identity}"
+    return f"addr:{request.remote_addr}"
+
+
+def _find_budget(state):
+    """Return the budget declared by the resource handling the request."""
+    view = current_app.view_functions.get(request.endpoint)
+    name = getattr(getattr(view, "view_class", None), "admission_budget", None)
+    if callable(name):
+        name = name(request)
+    return state.budgets.get(name)
+
+
+def _reject(status: int, message: str, retry_after: float):
+    response = jsonify({"message": message})
+    response.status_code = status
+    response.headers["Retry-After"] = str(max(1, math.ceil(retry_after)))
+    return response
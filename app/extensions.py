@@ -4,6 +4,8 @@ from flask_jwt_extended import JWTManager
 from flask_restx import Api
 from flask_sqlalchemy import SQLAlchemy
 
+from .admission import AdmissionController
+
 # Initialize SQLAlchemy for database operations
 db = SQLAlchemy()
 
@@ -22,3 +24,6 @@ api = Api(
 
 bcrypt = Bcrypt()
 jwt = JWTManager()
+
+# Initialize admission control to bound queueing under overload
+admission = AdmissionController()
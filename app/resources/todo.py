@@ -103,6 +103,13 @@ class TodoResource(Resource):
 class TodoListResource(Resource):
     """Handles a list of todos and adds new todos."""
 
+    @staticmethod
+    def admission_budget(req):
+        """Charge searches against the 'search' admission budget."""
+        if req.method == "GET" and "search" in req.args:
+            return "search"
+        return None
+
     @jwt_required()
     @ns.doc("list_todos")
     @ns.marshal_with(response_model)
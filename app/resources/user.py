@@ -68,6 +68,9 @@ class UserRegistrationResource(Resource):
 # User Login Resource
 @ns.route("/login")
 class UserLoginResource(Resource):
+    # Password hashing is expensive, so logins have their own budget
+    admission_budget = "login"
+
     @ns.doc("login_user")
     @ns.expect(register_user_model)
     @ns.response(401, "Invalid credentials")
@@ -0,0 +1,399 @@
+"""Contains unittests and a load test for the admission control."""
+import math
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from flask.testing import FlaskClient
+from flask_jwt_extended import create_access_token
+
+from app import create_app, db
+from app.admission import (
+    ConcurrencyLimiter,
+    QueueWaitShedder,
+    TokenBucket,
+    TokenBucketRegistry,
+    charge,
+)
+from config import TestingConfig
+
+SERVICE_TIME = 0.05
+CREDENTIALS = {"username": "nobody", "password": "secret"}
+
+
+class RateLimitedConfig(TestingConfig):
+    """Testing configuration with a tiny per-user rate."""
+
+    ADMISSION_USER_RATE = 1.0
+    ADMISSION_USER_BURST = 2
+
+
+class SearchBudgetConfig(TestingConfig):
+    """Testing configuration with a search budget smaller than the user's."""
+
+    ADMISSION_USER_RATE = 0.01
+    ADMISSION_USER_BURST = 3
+    ADMISSION_BUDGETS = {
+        "search": {"rate": 0.01, "burst": 2, "concurrency": 4, "max_queue": 8},
+    }
+
+
+class UserLimitedConfig(TestingConfig):
+    """Testing configuration with a user rate smaller than the search's."""
+
+    ADMISSION_USER_RATE = 0.01
+    ADMISSION_USER_BURST = 2
+    ADMISSION_BUDGETS = {
+        "search": {"rate": 0.01, "burst": 5, "concurrency": 4, "max_queue": 8},
+    }
+
+
+class PlainConfig:
+    """Configuration object not derived from 'config.Config'."""
+
+    TESTING = True
+    SQLALCHEMY_DATABASE_URI = TestingConfig.SQLALCHEMY_DATABASE_URI
+    JWT_SECRET_KEY = TestingConfig.JWT_SECRET_KEY
+
+
+class SaturatedLoginConfig(TestingConfig):
+    """Testing configuration where only the login concurrency is limiting."""
+
+    ADMISSION_MAX_QUEUE_WAIT = 0.2
+    ADMISSION_USER_RATE = 10000.0
+    ADMISSION_USER_BURST = 10000
+    ADMISSION_BUDGETS = {
+        "login": {
+            "rate": 10000.0,
+            "burst": 10000,
+            "concurrency": 1,
+            "max_queue": 4,
+        },
+    }
+
+
+class SingleSlotConfig(SaturatedLoginConfig):
+    """Testing configuration serving a single request at a time."""
+
+    ADMISSION_MAX_CONCURRENCY = 1
+
+
+class OverloadConfig(TestingConfig):
+    """Testing configuration with a small capacity for the load test."""
+
+    ADMISSION_MAX_CONCURRENCY = 4
+    ADMISSION_MAX_QUEUE = 8
+    ADMISSION_MAX_QUEUE_WAIT = 0.2
+    ADMISSION_TARGET_QUEUE_WAIT = 0.05
+    ADMISSION_SHED_DECAY = 0.1
+    ADMISSION_USER_RATE = 10000.0
+    ADMISSION_USER_BURST = 10000
+
+
+@pytest.fixture
+def make_app():
+    """
+    Fixture creating apps from a given configuration.
+
+    Returns:
+        Callable: Factory taking a configuration class and returning an app.
+    """
+    apps = []
+
+    def factory(app_config):
+        app = create_app(app_config=app_config)
+        apps.append(app)
+        return app
+
+    yield factory
+
+    for app in apps:
+        with app.app_context():
+            db.drop_all()
+
+
+def _auth_headers(app):
+    with app.app_context():
+        return {"Authorization": f"Bearer {create_access_token(1)}"}
+
+
+def _add_slow_route(app):
+    @app.route("/slow")
+    def slow():
+        time.sleep(SERVICE_TIME)
+        return ""
+
+
+def test_token_bucket_refills_over_time():
+    """Test that an empty bucket admits again once refilled."""
+    # GIVEN a bucket with a single token
+    bucket = TokenBucket(rate=2.0, burst=1)
+    now = bucket.updated_at
+    # WHEN two tokens are taken at the same time
+    # THEN the first is admitted and the second has to wait half a second
+    assert bucket.consume(now) == 0.0
+    assert bucket.consume(now) == 0.5
+    # AND a token is available again after the wait
+    assert bucket.consume(now + 0.5) == 0.0
+
+
+def test_concurrency_limiter_rejects_when_queue_full():
+    """Test that the limiter never queues beyond its bound."""
+    # GIVEN a limiter with one slot taken and no room in the queue
+    limiter = ConcurrencyLimiter(limit=1, max_queue=0)
+    assert limiter.acquire(timeout=0.1) == 0.0
+    # WHEN another request asks for a slot
+    # THEN it is rejected immediately
+    assert limiter.acquire(timeout=0.1) is None
+    # AND a slot is available again once released
+    limiter.release()
+    assert limiter.acquire(timeout=0.1) == 0.0
+
+
+def test_registry_evicts_least_recent_client():
+    """Test that the registry never holds more buckets than its cap."""
+    # GIVEN a registry holding at most two buckets
+    registry = TokenBucketRegistry(rate=0.01, burst=1, max_entries=2)
+    assert charge([registry], "a") == 0.0
+    assert charge([registry], "b") == 0.0
+    assert charge([registry], "a") > 0.0
+    # WHEN a third client shows up
+    assert charge([registry], "c") == 0.0
+    # THEN the least recently seen client is evicted
+    assert len(registry) == 2
+    assert charge([registry], "a") > 0.0
+    assert charge([registry], "b") == 0.0
+
+
+def test_charge_takes_tokens_only_when_all_buckets_admit():
+    """Test that a rejected charge leaves every bucket untouched."""
+    # GIVEN an empty and a full registry for the same client
+    empty = TokenBucketRegistry(rate=0.01, burst=1, max_entries=10)
+    full = TokenBucketRegistry(rate=0.01, burst=1, max_entries=10)
+    charge([empty], "a")
+    # WHEN the client is charged against both
+    # THEN the charge is rejected
+    assert charge([full, empty], "a") > 0.0
+    # AND the full registry still holds its token
+    assert charge([full], "a") == 0.0
+
+
+def test_shedder_average_decays_when_idle():
+    """Test that the average queue wait decays once no samples arrive."""
+    # GIVEN a shedder that measured long queue waits
+    shedder = QueueWaitShedder(target=0.1, max_ratio=0.9, decay=1.0)
+    now = shedder.updated_at
+    for _ in range(10):
+        shedder.record(0.5, now)
+    assert shedder.current_wait(now) > shedder.target
+    # WHEN the server stays idle for two seconds
+    # THEN the average falls below the target and nothing is shed
+    assert shedder.current_wait(now + 2.0) < shedder.target
+    assert not shedder.should_shed(now + 2.0)
+
+
+def test_user_rate_limit_returns_429(make_app):
+    """Test that a user exceeding the rate receives a 429."""
+    # GIVEN an app allowing a burst of two requests per user
+    app = make_app(RateLimitedConfig)
+    client = app.test_client()
+    auth_headers = _auth_headers(app)
+    # WHEN the user sends three requests in a row
+    responses = [client.get("/todos", headers=auth_headers) for _ in range(3)]
+    # THEN the first two are served
+    assert [r.status_code for r in responses[:2]] == [200, 200]
+    # AND the third is rejected with a 'Retry-After' header
+    assert responses[2].status_code == 429
+    assert int(responses[2].headers["Retry-After"]) >= 1
+
+
+def test_search_has_own_budget(client: FlaskClient, auth_headers):
+    """Test that searching is charged against its own budget."""
+    # GIVEN the search budget allows a burst of five requests
+    # WHEN the user searches six times in a row
+    responses = [
+        client.get("/todos?search=foo", headers=auth_headers) for _ in range(6)
+    ]
+    # THEN the sixth search is rejected
+    assert responses[-1].status_code == 429
+    # AND plain listing is still served
+    assert client.get("/todos", headers=auth_headers).status_code == 200
+
+
+def test_search_budget_429_leaves_user_bucket_untouched(make_app):
+    """Test that searches rejected by their budget cost no user tokens."""
+    # GIVEN a user with three tokens and a search budget of two
+    app = make_app(SearchBudgetConfig)
+    client = app.test_client()
+    auth_headers = _auth_headers(app)
+    # WHEN the user searches five times in a row
+    responses = [
+        client.get("/todos?search=foo", headers=auth_headers) for _ in range(5)
+    ]
+    # THEN the searches beyond the budget are rejected
+    assert [r.status_code for r in responses] == [200, 200, 429, 429, 429]
+    # AND only the two admitted searches were charged to the user
+    assert client.get("/todos", headers=auth_headers).status_code == 200
+    assert client.get("/todos", headers=auth_headers).status_code == 429
+
+
+def test_user_429_leaves_search_budget_untouched(make_app):
+    """Test that searches rejected by the user bucket cost no budget."""
+    # GIVEN a user with two tokens and a search budget of five
+    app = make_app(UserLimitedConfig)
+    client = app.test_client()
+    auth_headers = _auth_headers(app)
+    # WHEN the user searches six times in a row
+    responses = [
+        client.get("/todos?search=foo", headers=auth_headers) for _ in range(6)
+    ]
+    # THEN the searches beyond the user's rate are rejected
+    assert [r.status_code for r in responses] == [200, 200] + [429] * 4
+    # AND only the two admitted searches were charged to the budget
+    buckets = app.extensions["admission"].budgets["search"].buckets
+    assert buckets.get("user:1").tokens == pytest.approx(3, abs=0.01)
+
+
+def test_unknown_routes_are_not_charged(make_app):
+    """Test that 404s and redirects do not use up the user's rate."""
+    # GIVEN an app allowing a burst of two requests per user
+    app = make_app(RateLimitedConfig)
+    client = app.test_client()
+    auth_headers = _auth_headers(app)
+    # WHEN the user requests unknown routes
+    for _ in range(3):
+        assert client.get("/nope", headers=auth_headers).status_code == 404
+    # THEN the user can still list todos
+    assert client.get("/todos/", headers=auth_headers).status_code == 200
+
+
+def test_config_without_admission_settings(make_app):
+    """Test that admission defaults apply to any configuration object."""
+    # GIVEN a configuration without any admission setting
+    # WHEN an app is created from it
+    app = make_app(PlainConfig)
+    # THEN the defaults are used
+    assert app.config["ADMISSION_ENABLED"] is True
+    assert "admission" in app.extensions
+    headers = _auth_headers(app)
+    client = app.test_client()
+    assert client.get("/todos", headers=headers).status_code == 200
+
+
+def test_login_budget_keyed_by_client_address(client: FlaskClient):
+    """Test that logins are rate limited per client address."""
+    # GIVEN the login budget allows a burst of five requests
+    # WHEN a client tries to log in six times in a row
+    responses = [
+        client.post("/users/login", json=CREDENTIALS) for _ in range(6)
+    ]
+    # THEN the first five are processed and the sixth is rejected
+    assert [r.status_code for r in responses[:5]] == [401] * 5
+    assert responses[5].status_code == 429
+    assert int(responses[5].headers["Retry-After"]) >= 1
+    # AND a client from another address can still log in
+    response = client.post(
+        "/users/login",
+        json=CREDENTIALS,
+        environ_base={"REMOTE_ADDR": "10.0.0.2"},
+    )
+    assert response.status_code == 401
+
+
+def test_saturated_login_budget_does_not_shed_todos(make_app):
+    """Test that a saturated login budget leaves other endpoints alone."""
+    # GIVEN the only login slot is taken
+    app = make_app(SaturatedLoginConfig)
+    auth_headers = _auth_headers(app)
+    login_limiter = app.extensions["admission"].budgets["login"].limiter
+    login_limiter.acquire(timeout=0)
+
+    def login():
+        return app.test_client().post("/users/login", json=CREDENTIALS)
+
+    # WHEN ten clients try to log in at the same time
+    with ThreadPoolExecutor(max_workers=10) as executor:
+        responses = list(executor.map(lambda _: login(), range(10)))
+    # THEN the logins are rejected as overloaded
+    assert [r.status_code for r in responses] == [503] * 10
+    # AND listing todos is still served without any shedding
+    client = app.test_client()
+    statuses = [
+        client.get("/todos", headers=auth_headers).status_code
+        for _ in range(20)
+    ]
+    assert statuses == [200] * 20
+
+
+def test_budget_and_global_queues_share_deadline(make_app):
+    """Test that waiting in two queues stays within the maximum wait."""
+    # GIVEN the login slot is freed after 0.15s and the global slot never is
+    app = make_app(SingleSlotConfig)
+    state = app.extensions["admission"]
+    state.limiter.acquire(timeout=0)
+    login_limiter = state.budgets["login"].limiter
+    login_limiter.acquire(timeout=0)
+    threading.Timer(0.15, login_limiter.release).start()
+    # WHEN a client tries to log in
+    start = time.monotonic()
+    response = app.test_client().post("/users/login", json=CREDENTIALS)
+    elapsed = time.monotonic() - start
+    # THEN it is rejected once the shared deadline has passed
+    assert response.status_code == 503
+    assert elapsed < SingleSlotConfig.ADMISSION_MAX_QUEUE_WAIT + 0.08
+
+
+def test_admits_normally_once_overload_stops(make_app):
+    """Test that shedding stops once the overload is over."""
+    # GIVEN the server measured long queue waits during an overload
+    app = make_app(OverloadConfig)
+    _add_slow_route(app)
+    shedder = app.extensions["admission"].shedder
+    for _ in range(10):
+        shedder.record(0.5, time.monotonic())
+    client = app.test_client()
+    statuses = [client.get("/slow").status_code for _ in range(20)]
+    assert 503 in statuses
+    # WHEN the load drops and the server stays idle for a moment
+    time.sleep(10 * OverloadConfig.ADMISSION_SHED_DECAY)
+    # THEN every request is admitted again
+    statuses = [client.get("/slow").status_code for _ in range(20)]
+    assert statuses == [200] * 20
+
+
+def test_p99_latency_bounded_under_overload(make_app):
+    """Test that p99 latency stays bounded at twice the capacity."""
+    # GIVEN an app serving a slow endpoint with a capacity of 80 req/s
+    app = make_app(OverloadConfig)
+    _add_slow_route(app)
+    capacity = OverloadConfig.ADMISSION_MAX_CONCURRENCY / SERVICE_TIME
+
+    def send(scheduled_at):
+        response = app.test_client().get("/slow")
+        return response.status_code, time.monotonic() - scheduled_at
+
+    # WHEN requests arrive at twice the capacity for two seconds
+    interval = 1 / (2 * capacity)
+    with ThreadPoolExecutor(max_workers=64) as executor:
+        futures = []
+        start = time.monotonic()
+        for i in range(int(4 * capacity)):
+            scheduled_at = start + i * interval
+            time.sleep(max(0.0, scheduled_at - time.monotonic()))
+            futures.append(executor.submit(send, scheduled_at))
+        results = [future.result() for future in futures]
+
+    statuses = [status for status, _ in results]
+    latencies = sorted(
+        latency for status, latency in results if status == 200
+    )
+    p99 = latencies[math.ceil(0.99 * len(latencies)) - 1]
+    # THEN part of the load is served and the excess is shed with a 503
+    assert statuses.count(200) > 0
+    assert statuses.count(503) > 0
+    assert set(statuses) <= {200, 503}
+    # AND the p99 latency of the served requests stays bounded by the queue
+    # wait plus service time, whereas an unbounded queue would grow to
+    # about two seconds
+    assert p99 < OverloadConfig.ADMISSION_MAX_QUEUE_WAIT + SERVICE_TIME + 0.25